@@ -1,27 +1,86 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Optional
-from pypdf import PdfWriter, PdfReader
+from starlette.background import BackgroundTask, BackgroundTasks
+from starlette.formparsers import MultiPartParser
+from typing import BinaryIO, List, Optional, Set, Tuple
+import pikepdf
 from docx import Document
 from docxcompose.composer import Composer
 from docx.enum.text import WD_BREAK
 
+import io
 import os
 import re
+import asyncio
+import contextlib
+import functools
+import gc
+import hashlib
 import shutil
 import tempfile
 import zipfile
-import rarfile
-import patoolib
+from urllib.parse import quote
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class UploadSizeLimitMiddleware:
+    """
+    Rechaza con 413 las peticiones cuyo cuerpo supera `max_bytes`: de entrada
+    por Content-Length y, si falta o miente, contando los bytes recibidos,
+    para no llegar a volcar subidas enormes a memoria o disco.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        detail = f"Upload exceeds the {self.max_bytes >> 20} MiB limit."
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse({"detail": detail}, status_code=413)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
 app = FastAPI(title="PDF and DOCX Merger API")
 
+# Mantener en memoria los archivos subidos de hasta 64 MiB (por defecto
+# Starlette los vuelca a disco a partir de 1 MiB); los ZIP se extraen
+# directamente desde ese stream. El atributo es de Starlette 0.27 (la que
+# fija requirements.txt); versiones posteriores lo renombran a spool_max_size,
+# así que se comprueba para que una actualización falle en lugar de ignorarlo
+if not hasattr(MultiPartParser, "max_file_size"):
+    raise RuntimeError("starlette.formparsers.MultiPartParser.max_file_size not found; update the spool size override")
+MultiPartParser.max_file_size = 64 << 20
+
+# Se registra antes que CORS para que la respuesta 413 también lleve sus cabeceras
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 500 << 20))
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=MAX_UPLOAD_BYTES)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -30,56 +89,342 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-os.makedirs("uploads", exist_ok=True)
+def _preimport_merge_libs() -> None:
+    # Cargar las librerías de fusión una sola vez por proceso trabajador
+    import pikepdf  # noqa: F401
+    import docx  # noqa: F401
+    import docxcompose.composer  # noqa: F401
+    # Excluir de las recolecciones completas los objetos de larga vida ya
+    # cargados, así el GC solo recorre lo que genera cada fusión
+    gc.freeze()
+
+MERGE_WORKERS = int(os.environ.get("MERGE_WORKERS", min(os.cpu_count() or 4, 8)))
+# Cada fusión mantiene el documento resultante en memoria hasta que termina la
+# descarga; limitar cuántas hay en curso a la vez acota el consumo cuando
+# llegan varias grandes juntas. Un cliente lento ocupa su hueco mientras
+# descarga, por eso el límite por defecto duplica el tamaño del pool: así unas
+# pocas descargas lentas no dejan los procesos de fusión parados
+MAX_INFLIGHT_MERGES = int(os.environ.get("MAX_INFLIGHT_MERGES", 2 * MERGE_WORKERS))
+
+def create_merge_executor() -> ProcessPoolExecutor:
+    # forkserver en lugar de fork: el proceso principal tiene hilos de extracción
+    # en marcha y hacer fork con hilos activos puede dejar locks bloqueados en
+    # el hijo
+    return ProcessPoolExecutor(
+        max_workers=MERGE_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=_preimport_merge_libs,
+    )
+
+merge_executor = create_merge_executor()
+merge_slots: Optional[asyncio.Semaphore] = None
+
+@app.on_event("startup")
+async def create_merge_slots() -> None:
+    # Se crea dentro del event loop de uvicorn
+    global merge_slots
+    merge_slots = asyncio.Semaphore(MAX_INFLIGHT_MERGES)
+
+async def release_merge_slot() -> None:
+    # Asíncrona para que Starlette la ejecute en el event loop y no en el
+    # threadpool: asyncio.Semaphore no es seguro entre hilos
+    merge_slots.release()
+
+@app.on_event("shutdown")
+def shutdown_merge_executor() -> None:
+    merge_executor.shutdown(wait=False, cancel_futures=True)
+
+def replace_broken_merge_executor(broken: ProcessPoolExecutor) -> None:
+    """
+    Si un trabajador muere (p. ej. por falta de memoria) el pool queda roto
+    para siempre; se sustituye por uno nuevo. Solo lo hace la primera
+    petición que lo detecta, las demás ya verán el pool nuevo.
+    """
+    global merge_executor
+    if merge_executor is broken:
+        logger.error("Un proceso de fusión terminó de forma inesperada; se reinicia el pool")
+        merge_executor = create_merge_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+# Directorio para los archivos extraídos (p. ej. /dev/shm); por defecto, el temporal del sistema
+MERGE_TMPDIR = os.environ.get("MERGE_TMPDIR") or None
+
+VALID_EXTENSIONS = {'.pdf', '.docx'}
+RESPONSE_CHUNK_SIZE = 1 << 20
+COPY_BUFFER_SIZE = 1 << 20
+ZIP_EXTRACT_WORKERS = 8
+# Cabecera local y, para ZIP vacíos, fin del directorio central
+ZIP_SIGNATURES = (b'PK\x03\x04', b'PK\x05\x06')
+# Formatos que libarchive extrae en el mismo proceso; los tar comprimidos se
+# reconocen por la cabecera del compresor (gzip, bzip2, xz)
+LIBARCHIVE_SIGNATURES = {
+    b'Rar!\x1a\x07': "rar",
+    b'7z\xbc\xaf\x27\x1c': "7z",
+    b'\x1f\x8b': "gzip",
+    b'BZh': "bzip2",
+    b'\xfd7zXZ\x00': "xz",
+}
+TAR_MAGIC_OFFSET = 257
+# PDF y DOCX apenas comprimen; una entrada grande que se expande más de
+# 100 veces es casi seguro una bomba ZIP
+MAX_COMPRESSION_RATIO = 100
+ZIP_RATIO_MIN_SIZE = 1 << 20
+MAX_EXTRACTED_BYTES = int(os.environ.get("MAX_EXTRACTED_BYTES", 2 << 30))
+_PART_RE = re.compile(r'part(\d+)', re.IGNORECASE)
 
 # Utilidades
+@functools.lru_cache(maxsize=1024)
 def extract_part_number(filename: str) -> int:
-    match = re.search(r'part(\d+)', filename.lower())
+    match = _PART_RE.search(filename)
     return int(match.group(1)) if match else 0
 
-def sort_files_by_part(files: List[str]) -> List[str]:
-    return sorted(files, key=lambda f: extract_part_number(os.path.basename(f)))
+def file_extension(basename: str) -> str:
+    """
+    Extensión en minúsculas de un nombre sin directorio ('.pdf'), o '' si no
+    tiene. Como os.path.splitext, ignora el punto inicial de los ocultos, pero
+    con un solo rfind en lugar de buscar separadores.
+    """
+    dot = basename.rfind('.')
+    return basename[dot:].lower() if dot > 0 else ''
 
-def extract_compressed_file(file_path: str, extract_dir: str) -> List[str]:
-    extracted_files = []
-    try:
-        try:
-            with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                zip_ref.extractall(extract_dir)
-                return [os.path.join(extract_dir, name) for name in zip_ref.namelist() if not name.endswith('/')]
-        except zipfile.BadZipFile:
-            pass
+def select_and_sort_files(file_paths: List[str], extensions: Set[str]) -> Tuple[str, List[str]]:
+    """
+    Filtra, valida y ordena los archivos extraídos en una sola pasada.
+    Devuelve la extensión común y las rutas ordenadas por número de parte.
+    """
+    entries = []
+    exts = set()
+    for path in file_paths:
+        base = os.path.basename(path)
+        ext = file_extension(base)
+        if ext not in extensions:
+            continue
+        exts.add(ext)
+        if len(exts) > 1:
+            raise HTTPException(status_code=400, detail="All files must be of the same type (PDF or DOCX).")
+        entries.append((extract_part_number(base), path))
+
+    if not entries:
+        raise HTTPException(status_code=400, detail="No valid PDF or DOCX files found.")
 
+    entries.sort()
+    return exts.pop(), [path for _, path in entries]
+
+def archive_too_large() -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"Archive contents exceed the {MAX_EXTRACTED_BYTES >> 20} MiB extraction limit.",
+    )
+
+def is_wanted_member(name: str, extensions: Set[str]) -> bool:
+    """
+    Decide, solo con el nombre de la entrada, si merece la pena extraerla:
+    descarta directorios, metadatos de macOS (__MACOSX/, ._*) y extensiones
+    que no se van a fusionar.
+    """
+    if name[-1:] == '/' or name.startswith('__MACOSX/'):
+        return False
+    base = name.rsplit('/', 1)[-1]
+    if base.startswith('._'):
+        return False
+    return file_extension(base) in extensions
+
+def member_target_path(root: str, name: str) -> Optional[str]:
+    """Ruta de destino dentro de `root`, o None si la entrada intenta salir de él."""
+    target = os.path.normpath(os.path.join(root, name.replace('\\', '/')))
+    return target if target.startswith(root) else None
+
+def open_preallocated(path: str, size: int) -> BinaryIO:
+    """
+    Abre `path` para escritura reservando antes `size` bytes, así el sistema
+    de archivos asigna el espacio de una vez en lugar de ampliarlo en cada
+    write. Si no se puede reservar (otro SO, FS sin soporte) se escribe igual.
+    La reserva también fija la longitud del archivo a `size`: si se escriben
+    menos bytes hay que truncarlo.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    if size > 0 and hasattr(os, "posix_fallocate"):
         try:
-            rarfile.UNRAR_TOOL = 'unrar'
-            with rarfile.RarFile(file_path) as rar_ref:
-                rar_ref.extractall(extract_dir)
-                return [os.path.join(extract_dir, name) for name in rar_ref.namelist() if not rar_ref.getinfo(name).isdir()]
-        except rarfile.NotRarFile:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
             pass
+    return os.fdopen(fd, "wb", buffering=COPY_BUFFER_SIZE)
+
+def extract_zip_member(zip_ref: zipfile.ZipFile, info: zipfile.ZipInfo, target: str) -> str:
+    """
+    Extrae un miembro del ZIP; pensado para llamarse desde varios hilos.
+    zipfile serializa las lecturas del archivo con un lock interno y zlib
+    libera el GIL al descomprimir, así que los miembros se inflan en paralelo.
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with zip_ref.open(info) as src, open_preallocated(target, info.file_size) as dst:
+        shutil.copyfileobj(src, dst, length=COPY_BUFFER_SIZE)
+    return target
+
+def extract_zip_entries(stream: BinaryIO, extract_dir: str, extensions: Set[str]) -> List[str]:
+    root = os.path.join(os.path.abspath(extract_dir), "")
+    stream.seek(0)
+    with zipfile.ZipFile(stream, 'r') as zip_ref:
+        # Indexado por destino: nombres repetidos (o iguales tras normalizarlos)
+        # se quedan con la última entrada, como hacía extractall, y no se
+        # escriben a la vez desde dos hilos sobre el mismo archivo
+        targets = {}
+        for info in zip_ref.infolist():
+            if not is_wanted_member(info.filename, extensions):
+                continue
+            if info.file_size > ZIP_RATIO_MIN_SIZE and info.file_size > info.compress_size * MAX_COMPRESSION_RATIO:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Archive member {info.filename} has a suspicious compression ratio.",
+                )
+            target = member_target_path(root, info.filename)
+            if target:
+                targets[target] = info
+        jobs = [(info, target) for target, info in targets.items()]
+
+        # zipfile nunca descomprime más de file_size, así que basta con los metadatos
+        if sum(info.file_size for info, _ in jobs) > MAX_EXTRACTED_BYTES:
+            raise archive_too_large()
 
-        patoolib.extract_archive(file_path, outdir=extract_dir)
-        for root, _, files in os.walk(extract_dir):
-            for file in files:
-                extracted_files.append(os.path.join(root, file))
+        if len(jobs) < 2:
+            return [extract_zip_member(zip_ref, info, target) for info, target in jobs]
+        with ThreadPoolExecutor(max_workers=min(ZIP_EXTRACT_WORKERS, len(jobs))) as pool:
+            return list(pool.map(lambda job: extract_zip_member(zip_ref, *job), jobs))
 
-        return extracted_files
+def extract_archive_entries(stream: BinaryIO, extract_dir: str, extensions: Set[str]) -> List[str]:
+    """
+    Extrae con libarchive (en el mismo proceso, sin lanzar unrar ni 7z)
+    leyendo directamente del stream.
+    """
+    # Importación diferida: libarchive-c carga libarchive.so al importarse y, si
+    # falta en el sistema, solo deben fallar los formatos que la necesitan
+    try:
+        import libarchive
+    except (ImportError, OSError, AttributeError) as e:
+        logger.error(f"libarchive no disponible: {str(e)}")
+        raise HTTPException(status_code=415, detail="RAR, 7z and tar archives are not supported on this server. Use ZIP.")
+
+    extracted_files = []
+    total_bytes = 0
+    root = os.path.join(os.path.abspath(extract_dir), "")
+    stream.seek(0)
+    with libarchive.stream_reader(stream, block_size=COPY_BUFFER_SIZE) as archive:
+        for entry in archive:
+            if not entry.isfile or not is_wanted_member(entry.pathname, extensions):
+                continue
+            target = member_target_path(root, entry.pathname)
+            if not target:
+                continue
+            # El tamaño de la cabecera puede mentir: se cuenta lo escrito de verdad
+            if total_bytes + (entry.size or 0) > MAX_EXTRACTED_BYTES:
+                raise archive_too_large()
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open_preallocated(target, entry.size or 0) as out:
+                for block in entry.get_blocks():
+                    total_bytes += len(block)
+                    if total_bytes > MAX_EXTRACTED_BYTES:
+                        raise archive_too_large()
+                    out.write(block)
+                # posix_fallocate fija la longitud al tamaño de la cabecera; si
+                # los datos reales son más cortos, quitar los ceros sobrantes
+                out.truncate(out.tell())
+            extracted_files.append(target)
+    return extracted_files
+
+def detect_archive_format(stream: BinaryIO) -> Optional[str]:
+    """Identifica el formato por los bytes mágicos de la cabecera."""
+    stream.seek(0)
+    header = stream.read(TAR_MAGIC_OFFSET + 5)
+    if header.startswith(ZIP_SIGNATURES):
+        return "zip"
+    for signature, archive_format in LIBARCHIVE_SIGNATURES.items():
+        if header.startswith(signature):
+            return archive_format
+    if header[TAR_MAGIC_OFFSET:] == b'ustar':
+        return "tar"
+    return None
+
+def extract_compressed_file(stream: BinaryIO, extract_dir: str, extensions: Set[str]) -> List[str]:
+    """
+    Extrae del archivo comprimido recibido como stream solo las entradas con
+    las extensiones indicadas, sin volcarlo antes a disco. Los ZIP usan
+    zipfile; RAR, 7z y tar (también comprimidos), libarchive.
+    Ambos necesitan seekable()/readinto() en el stream, que
+    SpooledTemporaryFile solo implementa desde Python 3.11.
+    """
+    archive_format = detect_archive_format(stream)
+    try:
+        if archive_format == "zip":
+            return extract_zip_entries(stream, extract_dir, extensions)
+        if archive_format is not None:
+            return extract_archive_entries(stream, extract_dir, extensions)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error extracting archive: {str(e)}")
 
-def filter_files_by_extension(file_paths: List[str], extensions: List[str]) -> List[str]:
-    return [p for p in file_paths if os.path.splitext(p)[1].lower() in extensions]
+    raise HTTPException(status_code=415, detail="Unsupported archive format. Use ZIP, RAR, 7z or tar.")
+
+def merge_pdf_files(file_paths: List[str], output: BinaryIO, optimize: bool = False) -> None:
+    """
+    Concatena los PDF con pikepdf (qpdf): las páginas se injertan en el
+    documento nuevo sin volver a serializar su contenido en Python.
+    Con `optimize`, los objetos se agrupan en object streams y los streams
+    Flate se recomprimen para reducir el tamaño, a costa de más CPU.
+    """
+    save_options = {"linearize": False}
+    if optimize:
+        save_options.update(
+            object_stream_mode=pikepdf.ObjectStreamMode.generate,
+            compress_streams=True,
+            recompress_flate=True,
+        )
+    try:
+        # Los PDF de origen deben seguir abiertos (mapeados en memoria)
+        # hasta que se guarde el resultado
+        with contextlib.ExitStack() as stack:
+            merged = stack.enter_context(pikepdf.Pdf.new())
+            for path in file_paths:
+                src = stack.enter_context(pikepdf.Pdf.open(path, access_mode=pikepdf.AccessMode.mmap))
+                merged.pages.extend(src.pages)
+            merged.save(output, **save_options)
+    except pikepdf.PdfError as e:
+        logger.error(f"Error al fusionar PDFs: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error al fusionar PDFs: {str(e)}")
+
+class SameTemplateComposer(Composer):
+    """
+    Composer para documentos cuyo styles.xml es idéntico al del maestro y no
+    tiene estilos numerados: todos los estilos usados ya existen con el mismo
+    id, así que no hay nada que copiar ni renombrar y se omite el recorrido de
+    estilos por elemento. Con estilos numerados no sirve, porque add_styles
+    también mapea sus abstractNum a los del maestro para que las listas
+    añadidas no se dupliquen ni reinicien.
+    """
+
+    def add_styles(self, doc, element):
+        pass
 
-def merge_pdf_files(file_paths: List[str], output_path: str) -> None:
-    merger = PdfWriter()
+def share_styles(file_paths: List[str]) -> bool:
+    """
+    Indica si todos los DOCX tienen exactamente el mismo word/styles.xml y
+    ningún estilo lleva numeración (w:numId).
+    """
+    digests = set()
     for path in file_paths:
-        reader = PdfReader(path)
-        for page in reader.pages:
-            merger.add_page(page)
-    with open(output_path, "wb") as out:
-        merger.write(out)
+        try:
+            with zipfile.ZipFile(path) as zf:
+                styles = zf.read("word/styles.xml")
+        except (KeyError, zipfile.BadZipFile):
+            return False
+        if b":numId" in styles:
+            return False
+        digests.add(hashlib.sha1(styles).digest())
+        if len(digests) > 1:
+            return False
+    return True
 
-def merge_docx_simple(file_paths: List[str], output_path: str) -> None:
+def merge_docx_simple(file_paths: List[str], output: BinaryIO) -> None:
     """
     Fusiona archivos DOCX de manera simple usando docxcompose.
     Cada documento se inserta como una nueva sección con su propio encabezado
@@ -88,15 +433,14 @@ def merge_docx_simple(file_paths: List[str], output_path: str) -> None:
     if not file_paths:
         raise HTTPException(status_code=400, detail="No DOCX files provided")
     
-    if len(file_paths) == 1:
-        # Si solo hay un archivo, simplemente copiarlo
-        shutil.copy(file_paths[0], output_path)
-        return
-    
     try:
         # Crear un documento base con el primer archivo
         master = Document(file_paths[0])
-        composer = Composer(master)
+        if share_styles(file_paths):
+            logger.info("Todos los documentos comparten styles.xml; se omite la fusión de estilos")
+            composer = SameTemplateComposer(master)
+        else:
+            composer = Composer(master)
         
         # Agregar cada documento adicional con un salto de página antes
         for i, file_path in enumerate(file_paths[1:], 1):
@@ -117,19 +461,57 @@ def merge_docx_simple(file_paths: List[str], output_path: str) -> None:
             composer.append(doc)
         
         # Guardar el documento combinado
-        composer.save(output_path)
-        logger.info(f"Documento combinado guardado en {output_path}")
+        composer.save(output)
+        logger.info("Documento combinado generado")
         
     except Exception as e:
         logger.error(f"Error al fusionar documentos: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error al fusionar documentos: {str(e)}")
 
+class MergeError(Exception):
+    """Error de fusión serializable entre procesos (HTTPException no lo es)."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+def run_merge(merge_fn, file_paths: List[str]) -> bytes:
+    """
+    Ejecuta la fusión dentro del proceso trabajador y devuelve el documento
+    resultante en memoria.
+    """
+    output = io.BytesIO()
+    try:
+        merge_fn(file_paths, output)
+    except HTTPException as e:
+        raise MergeError(e.status_code, e.detail) from None
+    return output.getvalue()
+
+def content_disposition(filename: str) -> str:
+    """
+    Cabecera Content-Disposition igual que la de FileResponse de Starlette:
+    las cabeceras se codifican en latin-1, así que los nombres que cambian
+    al citarlos (no ASCII, comillas...) van en filename* codificados en UTF-8.
+    """
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+async def iter_chunks(data: bytes, chunk_size: int = RESPONSE_CHUNK_SIZE):
+    # Generador asíncrono: Starlette itera los síncronos en el threadpool,
+    # un salto de hilo por bloque que no hace falta para cortar bytes
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+
 @app.post("/api/merge/")
 async def api_merge_files(
     file: Optional[UploadFile] = File(None),
     data: Optional[UploadFile] = File(None),
     archive: Optional[UploadFile] = File(None),
     output_filename: Optional[str] = Form("merged_document"),
+    optimize: bool = Form(False),
     request: Request = None
 ):
     actual_file = file or data or archive
@@ -142,34 +524,72 @@ async def api_merge_files(
     if not actual_file:
         raise HTTPException(status_code=400, detail="No file provided.")
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_path = os.path.join(temp_dir, "archive_input")
-        with open(temp_path, "wb") as f:
-            shutil.copyfileobj(actual_file.file, f)
-
+    # La extracción, la fusión y la limpieza del directorio temporal se hacen
+    # fuera del event loop para no bloquear otras peticiones
+    loop = asyncio.get_running_loop()
+    temp_dir = tempfile.mkdtemp(dir=MERGE_TMPDIR)
+    slot_held = False
+    try:
         extract_dir = os.path.join(temp_dir, "extracted")
         os.makedirs(extract_dir, exist_ok=True)
-        extracted = extract_compressed_file(temp_path, extract_dir)
-
-        valid_exts = ['.pdf', '.docx']
-        filtered = filter_files_by_extension(extracted, valid_exts)
-        if not filtered:
-            raise HTTPException(status_code=400, detail="No valid PDF or DOCX files found.")
+        extracted = await loop.run_in_executor(None, extract_compressed_file, actual_file.file, extract_dir, VALID_EXTENSIONS)
 
-        sorted_files = sort_files_by_part(filtered)
-        ext = os.path.splitext(sorted_files[0])[1].lower()
-        output_path = f"uploads/{output_filename}{ext}"
+        ext, sorted_files = select_and_sort_files(extracted, VALID_EXTENSIONS)
+        download_name = f"{output_filename}{ext}"
 
         if ext == ".pdf":
-            merge_pdf_files(sorted_files, output_path)
+            merge_fn = functools.partial(merge_pdf_files, optimize=optimize)
             media_type = "application/pdf"
         elif ext == ".docx":
-            merge_docx_simple(sorted_files, output_path)
+            merge_fn = merge_docx_simple
             media_type = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
         else:
             raise HTTPException(status_code=400, detail="Unsupported file type.")
 
-        return FileResponse(path=output_path, filename=os.path.basename(output_path), media_type=media_type)
+        if len(sorted_files) == 1 and not (optimize and ext == ".pdf"):
+            # Un solo documento: se envía desde disco tal cual, sin analizarlo
+            # ni cargarlo en memoria; el directorio se borra tras la descarga
+            return FileResponse(
+                sorted_files[0],
+                filename=download_name,
+                media_type=media_type,
+                background=BackgroundTask(shutil.rmtree, temp_dir, True),
+            )
+
+        # El hueco se libera al terminar la descarga, no al acabar la fusión,
+        # porque el documento sigue en memoria mientras se envía
+        await merge_slots.acquire()
+        slot_held = True
+        # Leer el pool después de esperar el hueco: mientras tanto otra petición
+        # puede haber sustituido uno roto
+        executor = merge_executor
+        try:
+            merged = await loop.run_in_executor(executor, run_merge, merge_fn, sorted_files)
+        except MergeError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        except BrokenProcessPool:
+            replace_broken_merge_executor(executor)
+            raise HTTPException(status_code=503, detail="The merge worker crashed. Please retry the request.")
+
+        # Como en el caso de un solo documento, el directorio se borra después
+        # de enviar la respuesta para no sumar la limpieza a la latencia
+        cleanup = BackgroundTasks()
+        cleanup.add_task(shutil.rmtree, temp_dir, True)
+        cleanup.add_task(release_merge_slot)
+        return StreamingResponse(
+            iter_chunks(merged),
+            background=cleanup,
+            media_type=media_type,
+            headers={
+                "Content-Disposition": content_disposition(download_name),
+                "Content-Length": str(len(merged)),
+            },
+        )
+    except BaseException:
+        if slot_held:
+            merge_slots.release()
+        await loop.run_in_executor(None, shutil.rmtree, temp_dir, True)
+        raise
 
 if __name__ == "__main__":
     import uvicorn